@@ -0,0 +1,31 @@
+import re
+from typing import Optional
+
+# Lectura de los errores de cuota (429) de Gemini: cuánto pide esperar el servidor y si lo que
+# se ha agotado es la cuota diaria. No depende del SDK, solo de los atributos 'details' que
+# trae el error y de su texto, así que sirve igual para ResourceExhausted y TooManyRequests.
+
+
+def leer_retry_delay(error: Exception) -> Optional[float]:
+    """
+    Devuelve los segundos de espera que sugiere Gemini (RetryInfo.retryDelay) en un error
+    de cuota, o None si no los indica.
+    """
+    for detalle in getattr(error, "details", None) or []:
+        retry_delay = getattr(detalle, "retry_delay", None)
+        if retry_delay is not None:
+            return retry_delay.seconds + retry_delay.nanos / 1e9
+    # Sin detalles estructurados, se busca en el texto: '"retryDelay": "59s"' o 'retry_delay { seconds: 59 }'
+    coincidencia = re.search(r'retry_?delay\W*(?:seconds:\s*)?(\d+(?:\.\d+)?)', str(error), re.IGNORECASE)
+    return float(coincidencia.group(1)) if coincidencia else None
+
+def es_cuota_diaria(error: Exception) -> bool:
+    """
+    Indica si el error se debe a la cuota diaria (QuotaFailure con un quotaId '...PerDay...')
+    y no al límite por minuto.
+    """
+    for detalle in getattr(error, "details", None) or []:
+        for violacion in getattr(detalle, "violations", None) or []:
+            if "PerDay" in getattr(violacion, "quota_id", ""):
+                return True
+    return re.search(r'quota_?id\W*[\w-]*PerDay', str(error), re.IGNORECASE) is not None
@@ -0,0 +1,83 @@
+import hashlib
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Optional
+
+# --- Configuración ---
+# Caché local de respuestas de Gemini, para no repetir consultas al volver a procesar un vídeo.
+# Se puede cambiar la ubicación de la base de datos con la variable de entorno GEMINI_CACHE_PATH.
+RUTA_CACHE = Path(os.getenv("GEMINI_CACHE_PATH", Path(__file__).with_name("gemini_cache.sqlite")))
+
+# Bytes que se leen del principio y del final de cada vídeo para calcular su huella.
+TAMANO_BLOQUE_HUELLA = 1024 * 1024
+
+activa = True
+_conexion: Optional[sqlite3.Connection] = None
+
+
+def _obtener_conexion() -> sqlite3.Connection:
+    """
+    Abre la base de datos la primera vez que se usa y crea la tabla si no existe.
+    """
+    global _conexion
+    if _conexion is None:
+        _conexion = sqlite3.connect(RUTA_CACHE)
+        _conexion.execute("CREATE TABLE IF NOT EXISTS cache(k TEXT PRIMARY KEY, v BLOB, ts INTEGER)")
+    return _conexion
+
+def desactivar():
+    """
+    Desactiva la caché para el resto de la ejecución (opción --no-cache).
+    """
+    global activa
+    activa = False
+
+def calcular_huella(ruta: Path) -> str:
+    """
+    Calcula la huella de un archivo: el SHA-256 de su tamaño y de su primer y último mega.
+    Los vídeos pueden ocupar varios GB y estar en una unidad de red, así que no se lee el
+    archivo entero; el tamaño y los extremos bastan para distinguir dos grabaciones.
+    """
+    with open(ruta, "rb") as f:
+        tamano = os.fstat(f.fileno()).st_size
+        sha = hashlib.sha256(tamano.to_bytes(8, "big"))
+        sha.update(f.read(TAMANO_BLOQUE_HUELLA))
+        if tamano > TAMANO_BLOQUE_HUELLA:
+            f.seek(max(tamano - TAMANO_BLOQUE_HUELLA, TAMANO_BLOQUE_HUELLA))
+            sha.update(f.read())
+    return sha.hexdigest()
+
+def calcular_clave(*partes: str) -> str:
+    """
+    Calcula la clave de caché a partir del modelo, el texto del prompt y las huellas de
+    los archivos. Cada parte va precedida de su longitud (8 bytes) para que dos
+    combinaciones distintas no puedan producir la misma secuencia de bytes.
+    """
+    sha = hashlib.sha256()
+    for parte in partes:
+        datos = parte.encode()
+        sha.update(len(datos).to_bytes(8, "big"))
+        sha.update(datos)
+    return sha.hexdigest()
+
+def get(clave: str) -> Optional[str]:
+    """
+    Devuelve la respuesta guardada para una clave, o None si no está en la caché.
+    """
+    if not activa:
+        return None
+    fila = _obtener_conexion().execute("SELECT v FROM cache WHERE k = ?", (clave,)).fetchone()
+    return fila[0] if fila else None
+
+def set(clave: str, valor: str):
+    """
+    Guarda (o sustituye) la respuesta asociada a una clave.
+    """
+    if not activa:
+        return
+    with _obtener_conexion() as conexion:
+        conexion.execute(
+            "INSERT OR REPLACE INTO cache(k, v, ts) VALUES (?, ?, ?)", (clave, valor, int(time.time()))
+        )
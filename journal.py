@@ -0,0 +1,59 @@
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Optional
+
+# --- Configuración ---
+# Registro local del resultado de cada vídeo procesado, indexado por la huella de su contenido
+# (gemini_cache.calcular_huella), para que volver a ejecutar el script no repita trabajo ya hecho.
+# Se puede cambiar la ubicación de la base de datos con la variable de entorno JOURNAL_PATH.
+RUTA_JOURNAL = Path(os.getenv("JOURNAL_PATH", Path(__file__).with_name("journal.sqlite")))
+
+# Estados posibles de un vídeo en el registro
+OK = "ok"
+ERROR = "error"
+
+_conexion: Optional[sqlite3.Connection] = None
+
+
+def _obtener_conexion() -> sqlite3.Connection:
+    """
+    Abre la base de datos la primera vez que se usa y crea la tabla si no existe.
+    """
+    global _conexion
+    if _conexion is None:
+        _conexion = sqlite3.connect(RUTA_JOURNAL)
+        _conexion.row_factory = sqlite3.Row
+        _conexion.execute(
+            "CREATE TABLE IF NOT EXISTS journal("
+            "sha TEXT PRIMARY KEY, estado TEXT, resultado TEXT, transitorio INTEGER, ts INTEGER)"
+        )
+    return _conexion
+
+def _guardar(sha: str, estado: str, resultado: str, transitorio: bool):
+    with _obtener_conexion() as conexion:
+        conexion.execute(
+            "INSERT OR REPLACE INTO journal(sha, estado, resultado, transitorio, ts) VALUES (?, ?, ?, ?, ?)",
+            (sha, estado, resultado, int(transitorio), int(time.time())),
+        )
+
+def get_status(sha: str) -> Optional[sqlite3.Row]:
+    """
+    Devuelve el último resultado registrado para un vídeo (columnas estado, resultado,
+    transitorio y ts), o None si nunca se ha procesado.
+    """
+    return _obtener_conexion().execute("SELECT * FROM journal WHERE sha = ?", (sha,)).fetchone()
+
+def mark_success(sha: str, nombre: str):
+    """
+    Registra que el vídeo se procesó correctamente y el nombre base que se le dio.
+    """
+    _guardar(sha, OK, nombre, False)
+
+def mark_error(sha: str, error: str, transitorio: bool):
+    """
+    Registra que el procesamiento del vídeo falló. 'transitorio' indica si el fallo se debió a
+    un error pasajero de la API (límite de cuota, error 5xx...) y merece la pena reintentarlo.
+    """
+    _guardar(sha, ERROR, error, transitorio)
@@ -1,16 +1,37 @@
 import os
 import re
 import google.generativeai as genai
-from google.api_core.exceptions import ResourceExhausted
-from moviepy.editor import VideoFileClip
+from google.api_core.exceptions import DeadlineExceeded, ResourceExhausted, ServerError, TooManyRequests
+from googleapiclient.errors import HttpError
 import logging
 import argparse
+import asyncio
+import atexit
+import contextvars
+import functools
+import io
+import itertools
 from pathlib import Path
 from dotenv import load_dotenv
-from typing import Optional, List
+from typing import Callable, Dict, Iterable, Iterator, Optional, List, Tuple
+from pydantic import BaseModel, ValidationError
+from aiolimiter import AsyncLimiter
+import gemini_cache
+import journal
+from cuota_gemini import es_cuota_diaria, leer_retry_delay
+from puntuacion import extraer_puntuacion_rapida
+import random
 import shutil
+import subprocess
 import time
 
+# PyAV (bindings de libav) es opcional: si está instalado, el audio se decodifica dentro del
+# propio proceso en lugar de lanzar ffmpeg/ffprobe para cada vídeo.
+try:
+    import av
+except ImportError:
+    av = None
+
 # Cargar variables de entorno desde el archivo .env (para desarrollo local)
 load_dotenv()
 
@@ -18,12 +39,61 @@ load_dotenv()
 # Configura un logger para mostrar información de manera más clara
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Configura tu clave de Gemini.
-try:
+@functools.cache
+def _configurar_gemini():
+    """
+    Configura la clave de Gemini la primera vez que se necesita, y no al importar el módulo.
+    Lanza KeyError si la variable de entorno GEMINI_API_KEY no está configurada.
+    """
     genai.configure(api_key=os.environ["GEMINI_API_KEY"])
-except KeyError:
-    logging.error("La variable de entorno GEMINI_API_KEY no está configurada.")
-    exit()
+
+# Permite sustituir el modelo solo en la tarea actual (por ejemplo, por uno simulado en
+# pruebas o en un ensayo sin llamadas reales) sin tocar el que comparten todas las demás.
+modelo_gemini_actual: contextvars.ContextVar = contextvars.ContextVar("modelo_gemini_actual", default=None)
+
+@functools.cache
+def _modelo_compartido():
+    """
+    Crea una sola vez por proceso el modelo de Gemini que comparten todas las tareas.
+    Se puede elegir el modelo con la variable de entorno GEMINI_MODEL.
+    """
+    _configurar_gemini()
+    return genai.GenerativeModel(os.getenv("GEMINI_MODEL", "gemini-1.5-flash"))
+
+def get_gemini_model():
+    """
+    Devuelve el modelo de Gemini de la tarea actual si se ha sustituido, o el compartido.
+    """
+    return modelo_gemini_actual.get() or _modelo_compartido()
+
+# Número máximo de vídeos que se procesan a la vez. Casi todo el tiempo se va en
+# esperar a la red (Gemini) y al disco (ffmpeg), así que se solapan bien.
+MAX_VIDEOS_SIMULTANEOS = 5
+
+# Extensiones (en minúsculas) de los archivos que se procesan de la carpeta de subida.
+EXTENSIONES_VIDEO = {".mp4", ".mov", ".avi", ".mkv"}
+
+# Caracteres no válidos en nombres de archivo (en Windows), que se eliminan del título.
+_INVALID_FN_CHARS = re.compile(r'[\\/*?:"<>|]')
+
+# Segundos que se transcriben del inicio (título) y del final (puntuación) de cada vídeo.
+SEGUNDOS_TRAMO = 20
+
+# Espera máxima (en segundos) entre reintentos de una petición a Gemini.
+RETRASO_MAXIMO_REINTENTO = 60
+
+# Peticiones por minuto que se hacen como máximo a Gemini, sumando todas las llamadas del
+# proceso. La capa gratuita permite 15; en las de pago se puede subir con GEMINI_RPM.
+PETICIONES_POR_MINUTO = int(os.getenv("GEMINI_RPM", "14"))
+limitador_gemini = AsyncLimiter(PETICIONES_POR_MINUTO, 60)
+
+# Tiempo máximo (en segundos) que se espera a que Gemini termine de procesar un archivo subido.
+TIEMPO_MAXIMO_PROCESADO = 120
+
+class QuotaExhausted(Exception):
+    """
+    Se agotó la cuota diaria de Gemini: no tiene sentido reintentar hasta el día siguiente.
+    """
 
 # --- Funciones Auxiliares ---
 
@@ -35,190 +105,671 @@ def obtener_ruta_unica(ruta_propuesta: Path) -> Path:
     if not ruta_propuesta.exists():
         return ruta_propuesta
 
-    contador = 2
+    def con_contador(contador: int) -> Path:
+        return ruta_propuesta.with_stem(f"{ruta_propuesta.stem}({contador})")
+
+    # Búsqueda exponencial (2, 4, 8...) hasta dar con un sufijo libre y después binaria entre
+    # el último ocupado y ese, para hacer O(log n) comprobaciones en vez de una por duplicado.
+    # Como esta función asigna los sufijos en orden, los ocupados son consecutivos.
+    ocupado, libre = 1, 2
+    while con_contador(libre).exists():
+        ocupado, libre = libre, libre * 2
+    while libre - ocupado > 1:
+        medio = (ocupado + libre) // 2
+        if con_contador(medio).exists():
+            ocupado = medio
+        else:
+            libre = medio
+    return con_contador(libre)
+
+def reservar_ruta_unica(ruta_propuesta: Path) -> Path:
+    """
+    Elige un nombre libre con obtener_ruta_unica y lo reserva creando un archivo vacío con ese
+    nombre, para que otro vídeo que se mueva a la vez no pueda elegir el mismo. La creación
+    con 'x' falla si el archivo ya existe, así que si otro se adelanta se vuelve a buscar.
+    """
     while True:
-        nueva_ruta = ruta_propuesta.with_stem(f"{ruta_propuesta.stem}({contador})")
-        if not nueva_ruta.exists():
-            return nueva_ruta
-        contador += 1
+        ruta = obtener_ruta_unica(ruta_propuesta)
+        try:
+            open(ruta, "x").close()
+            return ruta
+        except FileExistsError:
+            continue
+
+def mover_archivo(origen: Path, destino: Path):
+    """
+    Mueve un archivo con un simple rename si origen y destino están en el mismo sistema
+    de archivos; si no (EXDEV u otro OSError), recurre a shutil.move, que lo copia.
+    """
+    try:
+        origen.replace(destino)
+    except OSError:
+        shutil.move(str(origen), str(destino))
+
+def iterar_videos(carpeta: Path) -> Iterator[Path]:
+    """
+    Recorre los vídeos de una carpeta (sin entrar en subcarpetas) a medida que se piden,
+    sin cargar antes la lista completa en memoria.
+    """
+    # Una sola pasada por el directorio; comparar en minúsculas incluye también '.MP4', '.MOV'...
+    with os.scandir(carpeta) as entradas:
+        for entrada in entradas:
+            if entrada.is_file() and Path(entrada.name).suffix.lower() in EXTENSIONES_VIDEO:
+                yield Path(entrada.path)
+
+def es_error_transitorio(error: Exception) -> bool:
+    """
+    Indica si un error de la API de Gemini es pasajero (límite de cuota por minuto, 5xx,
+    tiempo de espera agotado) y puede salir bien al reintentar más tarde.
+    """
+    if isinstance(error, HttpError):
+        return error.resp.status == 429 or error.resp.status >= 500
+    return isinstance(error, (ResourceExhausted, TooManyRequests, ServerError, DeadlineExceeded, TimeoutError))
 
-def gemini_request_with_retry(gemini_model, prompt, max_retries=3, delay=5):
+def como_error_de_cuota(error: Exception) -> Optional[TooManyRequests]:
+    """
+    Devuelve el error como TooManyRequests (o ResourceExhausted, que hereda de él) si se debe al
+    límite de cuota, o None si no. La API de archivos (upload_file, get_file) usa el cliente de
+    googleapiclient, que da un HttpError con estado 429 en vez de ResourceExhausted; se convierte
+    con el cuerpo de la respuesta como mensaje para poder leer retryDelay y quotaId.
     """
-    Envía una petición a Gemini con reintentos en caso de error de cuota.
+    if isinstance(error, TooManyRequests):
+        return error
+    if isinstance(error, HttpError) and error.resp.status == 429:
+        contenido = error.content.decode("utf-8", errors="replace") if isinstance(error.content, bytes) else str(error.content)
+        return TooManyRequests(contenido)
+    return None
+
+async def llamar_con_reintentos(funcion, *args, max_retries=10, **kwargs):
+    """
+    Espera (await) la llamada a una función asíncrona de Gemini, con reintentos en caso de
+    error de cuota. Cada intento pasa antes por el limitador de peticiones por minuto.
     """
     for attempt in range(max_retries):
         try:
-            response = gemini_model.generate_content(prompt)
-            return response
-        except ResourceExhausted as e:
-            logging.warning(f"Límite de cuota alcanzado. Reintentando en {delay} segundos... (Intento {attempt + 1}/{max_retries})")
-            time.sleep(delay)
+            async with limitador_gemini:
+                return await funcion(*args, **kwargs)
+        except (ResourceExhausted, TooManyRequests, HttpError) as e:
+            error_cuota = como_error_de_cuota(e)
+            if error_cuota is None:
+                raise # HttpError que no es de cuota
+            if es_cuota_diaria(error_cuota):
+                raise QuotaExhausted(f"Se agotó la cuota diaria de Gemini: {error_cuota}") from e
+            # Backoff exponencial con algo de aleatoriedad, pero nunca menos de lo que pide el servidor
+            espera = 2 ** attempt + random.uniform(0, 0.2 * 2 ** attempt)
+            retry_delay = leer_retry_delay(error_cuota)
+            if retry_delay is not None:
+                espera = max(espera, retry_delay + 2)
+            espera = min(espera, RETRASO_MAXIMO_REINTENTO)
+            logging.warning(f"Límite de cuota alcanzado. Reintentando en {espera:.1f} segundos... (Intento {attempt + 1}/{max_retries})")
+            await asyncio.sleep(espera)
         except Exception as e:
             # Para otros errores, fallar directamente
             raise e
     # Si todos los reintentos fallan
-    raise Exception("Se superó el número máximo de reintentos por límite de cuota.")
+    raise ResourceExhausted("Se superó el número máximo de reintentos por límite de cuota.")
+
+async def gemini_request_with_retry(prompt, max_retries=10, generation_config=None,
+                                    validar: Optional[Callable[[str], object]] = None) -> str:
+    """
+    Envía una petición a Gemini con reintentos en caso de error de cuota y devuelve el
+    texto de la respuesta. Las respuestas se guardan en la caché local, indexadas por el
+    modelo, el texto del prompt y la huella del vídeo de los audios que incluya.
+    Si se indica 'validar', se llama con el texto antes de guardarlo, para que una respuesta
+    que no pasa la validación (la excepción se propaga) no quede en la caché.
+    """
+    gemini_model = get_gemini_model()
+    partes = prompt if isinstance(prompt, list) else [prompt]
+    clave = gemini_cache.calcular_clave(
+        gemini_model.model_name,
+        *(parte.huella if isinstance(parte, AudioDiferido) else parte for parte in partes),
+    )
+    respuesta = gemini_cache.get(clave)
+    if respuesta is not None:
+        logging.info("Respuesta de Gemini obtenida de la caché local.")
+        return respuesta
+
+    # El audio solo se sube a Gemini cuando la respuesta no estaba en la caché
+    contenido = [await parte.obtener() if isinstance(parte, AudioDiferido) else parte for parte in partes]
+
+    response = await llamar_con_reintentos(
+        gemini_model.generate_content_async, contenido,
+        generation_config=generation_config, max_retries=max_retries,
+    )
+    if validar:
+        validar(response.text)
+    gemini_cache.set(clave, response.text)
+    return response.text
+
+
+async def ejecutar_comando(*comando: str) -> bytes:
+    """
+    Ejecuta un programa externo sin bloquear el bucle de eventos y devuelve su salida estándar.
+    """
+    proceso = await asyncio.create_subprocess_exec(
+        *comando, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    salida, _ = await proceso.communicate()
+    if proceso.returncode != 0:
+        raise subprocess.CalledProcessError(proceso.returncode, comando)
+    return salida
+
+def _duracion_av(ruta_video: Path) -> float:
+    """
+    Igual que obtener_duracion, pero leyendo los metadatos con PyAV.
+    """
+    with av.open(str(ruta_video)) as contenedor:
+        if contenedor.duration is not None:
+            return contenedor.duration / av.time_base
+        pista = contenedor.streams.audio[0]
+        if pista.duration is not None:
+            return float(pista.duration * pista.time_base)
+    raise ValueError(f"PyAV no pudo leer la duración de '{ruta_video.name}'.")
+
+async def obtener_duracion(ruta_video: Path) -> float:
+    """
+    Lee la duración del vídeo (en segundos) de los metadatos del contenedor con ffprobe,
+    sin decodificar nada. Si el contenedor no la indica ('N/A'), usa la de la pista de audio.
+    """
+    if av is not None:
+        return await asyncio.to_thread(_duracion_av, ruta_video)
+
+    salida = await ejecutar_comando(
+        "ffprobe", "-v", "error", "-select_streams", "a:0",
+        "-show_entries", "format=duration:stream=duration", "-of", "default=nw=1:nk=1", str(ruta_video),
+    )
+    # ffprobe escribe primero la duración de la pista y después la del contenedor
+    for valor in reversed(salida.decode().split()):
+        try:
+            return float(valor)
+        except ValueError:
+            continue
+    raise ValueError(f"ffprobe no pudo leer la duración de '{ruta_video.name}'.")
+
+def inicio_tramo_final(duracion: float) -> float:
+    """
+    Devuelve el segundo del audio generado por extraer_audio en el que empieza el tramo final.
+    """
+    if duracion <= 2 * SEGUNDOS_TRAMO:
+        return max(0, duracion - SEGUNDOS_TRAMO)
+    return SEGUNDOS_TRAMO
+
+def _extraer_audio_av(video_path: Path, duracion: float) -> bytes:
+    """
+    Igual que extraer_audio, pero decodificando y codificando con PyAV dentro del proceso.
+    """
+    if duracion <= 2 * SEGUNDOS_TRAMO:
+        tramos = [(0, duracion)]
+    else:
+        tramos = [(0, SEGUNDOS_TRAMO), (duracion - SEGUNDOS_TRAMO, duracion)]
+
+    buffer = io.BytesIO()
+    with av.open(str(video_path)) as entrada, av.open(buffer, mode="w", format="adts") as salida:
+        pista_entrada = entrada.streams.audio[0]
+        pista_salida = salida.add_stream("aac", rate=16000)
+        pista_salida.layout = "mono"
+        pista_salida.bit_rate = 32000
+        resampler = av.AudioResampler(format="fltp", layout="mono", rate=16000)
+
+        def codificar(frames):
+            for frame in frames:
+                # El codificador numera los frames de salida de forma continua entre los dos tramos
+                frame.pts = None
+                for paquete in pista_salida.encode(frame):
+                    salida.mux(paquete)
+
+        for inicio, fin in tramos:
+            # Sin pista indicada, seek() usa microsegundos (av.time_base) y salta al keyframe anterior
+            entrada.seek(int(inicio * av.time_base))
+            for frame in entrada.decode(pista_entrada):
+                if frame.time is None or frame.time + frame.samples / frame.sample_rate <= inicio:
+                    continue
+                if frame.time >= fin:
+                    break
+                frame.pts = None
+                codificar(resampler.resample(frame))
+
+        codificar(resampler.resample(None))
+        for paquete in pista_salida.encode(None):
+            salida.mux(paquete)
+
+    return buffer.getvalue()
+
+async def extraer_audio(video_path: Path, duracion: float) -> bytes:
+    """
+    Extrae en un único archivo AAC el audio de los primeros y de los últimos SEGUNDOS_TRAMO
+    segundos del vídeo, en mono a 16 kHz. Usa PyAV si está instalado y, si no, ffmpeg, cuyo
+    audio se lee directamente de su salida, sin pasar por un archivo temporal en disco.
+    """
+    if av is not None:
+        return await asyncio.to_thread(_extraer_audio_av, video_path, duracion)
+
+    salida = ["-vn", "-ac", "1", "-ar", "16000", "-c:a", "aac", "-b:a", "32k", "-f", "adts", "pipe:1"]
+
+    if duracion <= 2 * SEGUNDOS_TRAMO:
+        # Vídeo corto: su audio completo ya contiene el inicio y el final
+        return await ejecutar_comando("ffmpeg", "-i", str(video_path), *salida)
+
+    # Se abre el vídeo dos veces, buscando con -ss antes de -i en la segunda, para no
+    # decodificar la parte central, y se concatenan los dos tramos de audio
+    return await ejecutar_comando(
+        "ffmpeg",
+        "-t", str(SEGUNDOS_TRAMO), "-i", str(video_path),
+        "-ss", str(duracion - SEGUNDOS_TRAMO), "-i", str(video_path),
+        "-filter_complex", "[0:a][1:a]concat=n=2:v=0:a=1[audio]", "-map", "[audio]",
+        *salida,
+    )
+
+def _borrar_archivo_nube_ahora(nombre: str):
+    """
+    Elimina de Gemini un archivo subido, de forma síncrona y sin propagar errores.
+    """
+    try:
+        _configurar_gemini()
+        genai.delete_file(nombre)
+    except Exception as delete_e:
+        logging.error(f"Error al eliminar el archivo de la nube: {delete_e}")
+
+class BorradoEnSegundoPlano:
+    """
+    Nombres de los archivos subidos a Gemini pendientes de eliminar, y la tarea que los borra
+    uno a uno en segundo plano para que nadie tenga que esperar a una llamada a la API de la que
+    no depende ningún resultado. main() crea uno en cada ejecución, dentro de su bucle de eventos.
+    """
+    def __init__(self):
+        self.pendientes: asyncio.Queue = asyncio.Queue()
+        self.tarea = asyncio.create_task(self._borrar())
+
+    async def _borrar(self):
+        while True:
+            nombre = await self.pendientes.get()
+            try:
+                _configurar_gemini()
+                await llamar_con_reintentos(asyncio.to_thread, genai.delete_file, nombre)
+            except Exception as delete_e:
+                logging.error(f"Error al eliminar el archivo de la nube: {delete_e}")
+            finally:
+                self.pendientes.task_done()
+
+    async def cerrar(self):
+        """
+        Espera a que terminen los borrados pendientes y detiene la tarea.
+        """
+        await self.pendientes.join()
+        self.tarea.cancel()
+
+    def borrar_restantes(self):
+        """
+        Elimina de forma síncrona los archivos que sigan en la cola.
+        """
+        while not self.pendientes.empty():
+            _borrar_archivo_nube_ahora(self.pendientes.get_nowait())
+
+# Borrado en segundo plano de la ejecución actual de main(), o None fuera de ella.
+_borrado: Optional[BorradoEnSegundoPlano] = None
+
+def eliminar_archivo_nube(audio_file):
+    """
+    Programa la eliminación en Gemini de un archivo subido previamente, sin esperar a que termine.
+    Fuera de main() (sin borrado en segundo plano) se elimina en el momento.
+    """
+    if _borrado is None:
+        _borrar_archivo_nube_ahora(audio_file.name)
+    else:
+        _borrado.pendientes.put_nowait(audio_file.name)
+
+@atexit.register
+def _borrar_pendientes_al_salir():
+    """
+    Si el proceso termina sin haber vaciado la cola de borrado (por ejemplo, por una excepción
+    no controlada), elimina de forma síncrona los archivos que queden.
+    """
+    if _borrado is not None:
+        _borrado.borrar_restantes()
 
 
 # --- Funciones Principales de IA ---
 
-def transcribir_clip(video_path: Path, gemini_model, start_time: float, end_time: float, temp_dir: Path) -> Optional[str]:
+def _subir_bytes(datos: bytes, mime_type: str):
     """
-    Extrae un clip de un vídeo a un directorio temporal, lo sube y lo transcribe.
+    Sube a Gemini un audio que está en memoria. Se crea un BytesIO nuevo en cada llamada
+    para que un reintento no empiece a leer desde donde se quedó el intento anterior.
     """
-    audio_file = None
-    temp_clip_path = temp_dir / f"temp_clip_{int(time.time())}.mp4"
+    return genai.upload_file(path=io.BytesIO(datos), mime_type=mime_type)
+
+async def subir_audio(video_path: Path, duracion: float):
+    """
+    Extrae el audio del inicio y del final del vídeo y lo sube una sola vez a Gemini,
+    para transcribir ambos tramos sobre el mismo archivo.
+    """
+    logging.info(f"Extrayendo clip de audio de '{video_path.name}'...")
+    datos_audio = await extraer_audio(video_path, duracion)
+
+    logging.info("Subiendo archivo de audio para transcripción...")
+    # La API de archivos no pasa por el modelo, que puede ser uno sustituido para esta tarea
+    # (modelo_gemini_actual) y no haber configurado la clave
+    _configurar_gemini()
+    # El SDK de archivos de Gemini solo es síncrono: se ejecuta en un hilo aparte
+    audio_file = await llamar_con_reintentos(asyncio.to_thread, _subir_bytes, datos_audio, "audio/aac")
 
     try:
-        logging.info(f"Extrayendo clip de audio a '{temp_clip_path}'...")
-        with VideoFileClip(str(video_path)) as clip:
-            clip_sub = clip.subclip(start_time, end_time)
-            clip_sub.write_videofile(str(temp_clip_path), audio_codec="aac", verbose=False, logger=None)
-        
-        logging.info("Subiendo archivo de audio para transcripción...")
-        audio_file = genai.upload_file(path=temp_clip_path)
-        
         logging.info(f"Esperando a que el archivo '{audio_file.name}' esté activo...")
+        # Consultas cada vez más espaciadas: los clips cortos suelen estar listos enseguida
+        espera = 1.0
+        limite = time.monotonic() + TIEMPO_MAXIMO_PROCESADO
         while audio_file.state.name == "PROCESSING":
-            time.sleep(2)
-            audio_file = genai.get_file(name=audio_file.name)
+            if time.monotonic() >= limite:
+                raise TimeoutError(f"El archivo '{audio_file.name}' sigue procesándose tras {TIEMPO_MAXIMO_PROCESADO} segundos.")
+            await asyncio.sleep(espera)
+            espera = min(espera * 1.5, 10)
+            audio_file = await llamar_con_reintentos(asyncio.to_thread, genai.get_file, name=audio_file.name)
 
         if audio_file.state.name != "ACTIVE":
             raise Exception(f"El procesamiento del archivo falló: {audio_file.state.name}")
+    except Exception:
+        eliminar_archivo_nube(audio_file)
+        raise
 
-        logging.info("Transcribiendo audio con Gemini...")
-        prompt = ["Por favor, transcribe este audio en español.", audio_file]
-        response = gemini_request_with_retry(gemini_model, prompt)
-        
-        return response.text
+    return audio_file
 
+class AudioDiferido:
+    """
+    Audio de un vídeo que solo se extrae y se sube a Gemini la primera vez que se necesita.
+    Si todas las respuestas que lo usan están en la caché, no se llega a subir.
+    """
+    def __init__(self, video_path: Path, duracion: float, huella: str):
+        self.video_path = video_path
+        self.duracion = duracion
+        self.huella = huella
+        self.audio_file = None
+        self._lock = asyncio.Lock()
+
+    async def obtener(self):
+        async with self._lock:
+            if self.audio_file is None:
+                self.audio_file = await subir_audio(self.video_path, self.duracion)
+        return self.audio_file
+
+    def eliminar(self):
+        if self.audio_file:
+            eliminar_archivo_nube(self.audio_file)
+
+async def transcribir_tramo(audio: AudioDiferido, start_time: float, end_time: float) -> Optional[str]:
+    """
+    Transcribe un tramo del audio extraído de un vídeo.
+    """
+    try:
+        logging.info(f"Transcribiendo con Gemini el audio entre los segundos {start_time:.0f} y {end_time:.0f}...")
+        prompt = [
+            f"Por favor, transcribe en español únicamente el audio comprendido entre el segundo "
+            f"{start_time:.0f} y el segundo {end_time:.0f} de este archivo.",
+            audio,
+        ]
+        return await gemini_request_with_retry(prompt)
+
+    except QuotaExhausted:
+        raise
     except Exception as e:
         logging.error(f"No se pudo transcribir el clip de vídeo: {e}", exc_info=True)
         return None
-    finally:
-        if audio_file:
-            try:
-                genai.delete_file(audio_file.name)
-            except Exception as delete_e:
-                logging.error(f"Error al eliminar el archivo de la nube: {delete_e}")
 
-def obtener_nombre_pelicula(transcripcion: str, gemini_model) -> Optional[str]:
-    if not transcripcion: return None
-    
-    prompt = (
-        "Analiza la siguiente transcripción. Tu tarea es extraer el nombre de la película principal.\n"
-        "- IMPORTANTE: Si el título en la transcripción está en inglés, busca y devuelve el título con el que se estrenó oficialmente en España.\n"
-        "- Si la película existe y estás 100% seguro, devuelve ÚNICAMENTE su título oficial en español (de España).\n"
-        "- Si no estás seguro, no existe o no encuentras el título español, DEBES devolver: pelicula_no_encontrada\n\n"
-        f"Transcripción: \"{transcripcion}\""
-    )
-    try:
-        logging.info("Consultando a Gemini para obtener el nombre de la película...")
-        response = gemini_request_with_retry(gemini_model, prompt)
-        nombre_sucio = response.text.strip()
-        nombre_limpio = re.sub(r'[\\/*?:"<>|]', "", nombre_sucio)
-        return nombre_limpio if nombre_limpio else "nombre_desconocido"
-    except Exception as e:
-        logging.error(f"Error al contactar con la API de Gemini para el título: {e}", exc_info=True)
-        return "nombre_desconocido"
+class Critica(BaseModel):
+    """
+    Datos de una crítica que se piden a Gemini como respuesta JSON estructurada.
+    """
+    titulo: str
+    puntuacion: Optional[float]
+
+async def analizar_critica(texto_inicio: str, texto_final: str, max_reintentos_validacion=2) -> Tuple[str, str]:
+    """
+    Obtiene en una única consulta a Gemini el nombre de la película y la puntuación.
+    Si la puntuación se puede leer directamente de la transcripción final, solo se le pide
+    el título, sin enviarle esa transcripción.
+    Devuelve el nombre ya limpio para usarlo como nombre de archivo y la puntuación
+    como texto ('8', '9.5'), o 'no' si no se encontró.
+    """
+    puntuacion_rapida = extraer_puntuacion_rapida(texto_final)
+    if puntuacion_rapida is not None:
+        logging.info(f"Puntuación leída directamente de la transcripción: '{puntuacion_rapida}'")
+        instruccion_puntuacion = "- puntuacion: devuelve siempre null.\n\n"
+        transcripcion_final = ""
+    else:
+        instruccion_puntuacion = (
+            "- puntuacion: la puntuación numérica (de 0 a 10) que se da en [FIN], incluyendo decimales o 'y medio' (ej: 8, 9.5). "
+            "Si no hay puntuación, DEBES devolver null.\n\n"
+        )
+        transcripcion_final = f"\n\n[FIN] (final del vídeo)\n\"{texto_final}\""
 
-def obtener_puntuacion(transcripcion: str, gemini_model) -> str:
-    if not transcripcion: return "no"
     prompt = (
-        "Analiza la siguiente transcripción. Extrae la puntuación numérica (de 0 a 10).\n"
-        "- Si encuentras una puntuación (incluyendo decimales o 'y medio'), devuelve ÚNICAMENTE el número (ej: '8', '9.5').\n"
-        "- Si no hay puntuación, DEBES devolver: no\n\n"
-        f"Transcripción: \"{transcripcion}\""
+        "Analiza las siguientes transcripciones de una crítica de cine.\n"
+        "- titulo: el nombre de la película principal, que se presenta en [INICIO].\n"
+        "  - IMPORTANTE: Si el título en la transcripción está en inglés, busca y devuelve el título con el que se estrenó oficialmente en España.\n"
+        "  - Si la película existe y estás 100% seguro, devuelve ÚNICAMENTE su título oficial en español (de España).\n"
+        "  - Si no estás seguro, no existe o no encuentras el título español, DEBES devolver: pelicula_no_encontrada\n"
+        f"{instruccion_puntuacion}"
+        f"[INICIO] (comienzo del vídeo)\n\"{texto_inicio}\""
+        f"{transcripcion_final}"
     )
+    generation_config = {"response_mime_type": "application/json", "response_schema": Critica}
+
     try:
-        logging.info("Consultando a Gemini para obtener la puntuación...")
-        response = gemini_request_with_retry(gemini_model, prompt)
-        puntuacion_str = response.text.strip().replace(',', '.')
-        try:
-            valor_numerico = float(puntuacion_str)
-            if 0 <= valor_numerico <= 10:
-                return puntuacion_str
-            else:
-                return "no"
-        except ValueError:
-            return "no"
+        logging.info("Consultando a Gemini para obtener el nombre de la película y la puntuación...")
+        for attempt in range(max_reintentos_validacion + 1):
+            try:
+                respuesta = await gemini_request_with_retry(
+                    prompt, generation_config=generation_config, validar=Critica.model_validate_json
+                )
+                critica = Critica.model_validate_json(respuesta)
+                break
+            except ValidationError as e:
+                logging.warning(f"Respuesta de Gemini no válida (Intento {attempt + 1}/{max_reintentos_validacion + 1}): {e}")
+                prompt += (
+                    f"\n\nTu respuesta anterior no era válida:\n{e}\n"
+                    "Devuelve únicamente un JSON que cumpla el esquema pedido."
+                )
+        else:
+            return "nombre_desconocido", "no"
+    except QuotaExhausted:
+        raise
     except Exception as e:
-        logging.error(f"Error al contactar con la API de Gemini para la puntuación: {e}", exc_info=True)
-        return "no"
+        if es_error_transitorio(e):
+            raise
+        logging.error(f"Error al contactar con la API de Gemini para analizar la crítica: {e}", exc_info=True)
+        return "nombre_desconocido", "no"
+
+    # Windows tampoco admite nombres que terminen en punto o espacio
+    nombre_limpio = _INVALID_FN_CHARS.sub("", critica.titulo.strip()).rstrip(" .")
+    nombre_pelicula = nombre_limpio if nombre_limpio else "nombre_desconocido"
+
+    if puntuacion_rapida is not None:
+        puntuacion = puntuacion_rapida
+    elif critica.puntuacion is not None and 0 <= critica.puntuacion <= 10:
+        puntuacion = f"{critica.puntuacion:g}"
+    else:
+        puntuacion = "no"
+
+    return nombre_pelicula, puntuacion
 
 # --- Función Principal de Orquestación ---
 
-def procesar_un_video(ruta_video: Path, gemini_model, temp_dir: Path, destination_dir: Path):
+async def listar_errores_transitorios(error_dir: Path) -> Dict[Path, str]:
     """
-    Contiene la lógica para procesar un único archivo de vídeo.
+    Devuelve los vídeos de la carpeta de errores cuyo último fallo registrado en el journal
+    fue un error transitorio de la API, y que por tanto merece la pena volver a procesar,
+    junto con la huella ya calculada de cada uno.
+    """
+    if not error_dir.is_dir():
+        return {}
+
+    videos = {}
+    for ruta_video in iterar_videos(error_dir):
+        huella = await asyncio.to_thread(gemini_cache.calcular_huella, ruta_video)
+        registro = journal.get_status(huella)
+        if registro and registro["estado"] == journal.ERROR and registro["transitorio"]:
+            videos[ruta_video] = huella
+    return videos
+
+async def mover_a_errores(ruta_video: Path, destination_dir: Path):
+    """
+    Mueve a la carpeta 'error' un vídeo que no se ha podido identificar, con varios intentos.
+    """
+    # --- NUEVA LÓGICA DE MOVIMIENTO ROBUSTA ---
+    error_dir = destination_dir / "error"
+    os.makedirs(error_dir, exist_ok=True)
+    error_destination = error_dir / ruta_video.name
+    
+    max_retries = 3
+    for attempt in range(max_retries):
+        try:
+            logging.info(f"Intentando mover archivo no reconocido a '{error_destination}' (Intento {attempt + 1})...")
+            await asyncio.to_thread(mover_archivo, ruta_video, error_destination)
+            logging.info(f"Archivo movido a la carpeta de errores: '{error_destination}'")
+            return # Salir de la función si el movimiento tiene éxito
+        except Exception as move_error:
+            if attempt < max_retries - 1:
+                logging.warning(f"No se pudo mover el archivo (reintentando en 2 segundos): {move_error}")
+                await asyncio.sleep(2)
+            else:
+                logging.error(f"FALLO DEFINITIVO al mover el archivo '{ruta_video.name}' a la carpeta de errores: {move_error}", exc_info=True)
+
+async def procesar_un_video(ruta_video: Path, destination_dir: Path, huella: Optional[str] = None):
+    """
+    Contiene la lógica para procesar un único archivo de vídeo. Si ya se conoce la huella
+    del vídeo, se puede pasar en 'huella' para no volver a calcularla.
     """
     logging.info("-" * 50)
     logging.info(f"Procesando: {ruta_video.name}")
+    audio = None
 
     try:
-        with VideoFileClip(str(ruta_video)) as clip:
-            duracion_video = clip.duration
-        
-        texto_inicio = transcribir_clip(ruta_video, gemini_model, 0, min(20, duracion_video), temp_dir)
-        if not texto_inicio: return
-
-        nombre_pelicula = obtener_nombre_pelicula(texto_inicio, gemini_model)
-        if not nombre_pelicula or nombre_pelicula in ["nombre_desconocido", "pelicula_no_encontrada"]:
-            logging.warning(f"No se pudo obtener un nombre de película válido. Respuesta: '{nombre_pelicula}'.")
-            
-            # --- NUEVA LÓGICA DE MOVIMIENTO ROBUSTA ---
-            error_dir = destination_dir / "error"
-            os.makedirs(error_dir, exist_ok=True)
-            error_destination = error_dir / ruta_video.name
-            
-            max_retries = 3
-            for attempt in range(max_retries):
-                try:
-                    logging.info(f"Intentando mover archivo no reconocido a '{error_destination}' (Intento {attempt + 1})...")
-                    shutil.move(str(ruta_video), str(error_destination))
-                    logging.info(f"Archivo movido a la carpeta de errores: '{error_destination}'")
-                    return # Salir de la función si el movimiento tiene éxito
-                except Exception as move_error:
-                    if attempt < max_retries - 1:
-                        logging.warning(f"No se pudo mover el archivo (reintentando en 2 segundos): {move_error}")
-                        time.sleep(2)
-                    else:
-                        logging.error(f"FALLO DEFINITIVO al mover el archivo '{ruta_video.name}' a la carpeta de errores: {move_error}", exc_info=True)
-                        return # Salir de la función después del último intento fallido
-            return
+        if huella is None:
+            huella = await asyncio.to_thread(gemini_cache.calcular_huella, ruta_video)
+        registro = journal.get_status(huella)
+
+        if registro and registro["estado"] == journal.OK and gemini_cache.activa:
+            # Ya se identificó en una ejecución anterior: se reutiliza el nombre sin consultar a Gemini
+            # (salvo con --no-cache, que pide repetir las consultas)
+            nuevo_nombre_base = registro["resultado"]
+            logging.info(f"Vídeo ya procesado anteriormente como '{nuevo_nombre_base}'.")
+        else:
+            duracion_video = await obtener_duracion(ruta_video)
+            audio = AudioDiferido(ruta_video, duracion_video, huella)
             
-        logging.info(f"Película identificada: '{nombre_pelicula}'")
+            texto_inicio = await transcribir_tramo(audio, 0, min(SEGUNDOS_TRAMO, duracion_video))
+            if not texto_inicio:
+                journal.mark_error(huella, "No se pudo transcribir el inicio del vídeo.", transitorio=True)
+                return
 
-        texto_final = transcribir_clip(ruta_video, gemini_model, max(0, duracion_video - 20), duracion_video, temp_dir)
-        if not texto_final: return
-        logging.info(f"Texto extraído (final): \"{texto_final.strip()}\"")
-        
-        puntuacion = obtener_puntuacion(texto_final, gemini_model)
-        logging.info(f"Puntuación identificada: '{puntuacion}'")
+            texto_final = await transcribir_tramo(
+                audio, inicio_tramo_final(duracion_video), min(2 * SEGUNDOS_TRAMO, duracion_video)
+            )
+            if not texto_final:
+                journal.mark_error(huella, "No se pudo transcribir el final del vídeo.", transitorio=True)
+                return
+            logging.info(f"Texto extraído (final): \"{texto_final.strip()}\"")
 
-        nombre_puntuacion_seguro = puntuacion.replace('.', '_')
-        nuevo_nombre_base = f"{nombre_pelicula}_puntos_{nombre_puntuacion_seguro}"
-        
-        nueva_ruta_video = obtener_ruta_unica(ruta_video.with_stem(nuevo_nombre_base))
-        ruta_video.rename(nueva_ruta_video)
-        logging.info(f"Vídeo renombrado a: '{nueva_ruta_video.name}'")
+            try:
+                nombre_pelicula, puntuacion = await analizar_critica(texto_inicio, texto_final)
+            except QuotaExhausted:
+                raise
+            except Exception as e:
+                # analizar_critica solo deja pasar los errores transitorios de la API
+                logging.error(f"Error transitorio de Gemini al analizar la crítica: {e}")
+                journal.mark_error(huella, str(e), transitorio=True)
+                await mover_a_errores(ruta_video, destination_dir)
+                return
+
+            if not nombre_pelicula or nombre_pelicula in ["nombre_desconocido", "pelicula_no_encontrada"]:
+                logging.warning(f"No se pudo obtener un nombre de película válido. Respuesta: '{nombre_pelicula}'.")
+                journal.mark_error(huella, f"Nombre de película no válido: '{nombre_pelicula}'", transitorio=False)
+                await mover_a_errores(ruta_video, destination_dir)
+                return
+                
+            logging.info(f"Película identificada: '{nombre_pelicula}'")
+            logging.info(f"Puntuación identificada: '{puntuacion}'")
 
+            nombre_puntuacion_seguro = puntuacion.replace('.', '_')
+            nuevo_nombre_base = f"{nombre_pelicula}_puntos_{nombre_puntuacion_seguro}"
+        
+        journal.mark_success(huella, nuevo_nombre_base)
+
+        # Se mueve directamente con el nombre nuevo, sin renombrarlo antes en su carpeta, para que no
+        # aparezca un archivo nuevo en la carpeta de subida mientras todavía se está recorriendo
+        # El nombre queda reservado en cuanto se elige, así que el movimiento (que puede ser una
+        # copia completa si el destino está en otro disco) no hace esperar a los demás vídeos
+        final_destination = await asyncio.to_thread(
+            reservar_ruta_unica, destination_dir / ruta_video.with_stem(nuevo_nombre_base).name
+        )
         try:
-            final_destination = destination_dir / nueva_ruta_video.name
-            shutil.move(str(nueva_ruta_video), str(final_destination))
-            logging.info(f"Archivo movido a: '{final_destination}'")
+            await asyncio.to_thread(mover_archivo, ruta_video, final_destination)
+            logging.info(f"Vídeo renombrado y movido a: '{final_destination}'")
         except Exception as move_error:
-            logging.error(f"No se pudo mover el archivo '{nueva_ruta_video.name}' a '{destination_dir}': {move_error}", exc_info=True)
+            final_destination.unlink(missing_ok=True) # Se libera el nombre reservado; el original sigue en su sitio
+            logging.error(f"No se pudo mover el archivo '{ruta_video.name}' a '{final_destination}': {move_error}", exc_info=True)
 
+    except QuotaExhausted:
+        raise
     except Exception as e:
         logging.error(f"Ha ocurrido un error inesperado durante el procesamiento de '{ruta_video.name}': {e}", exc_info=True)
+        if huella:
+            journal.mark_error(huella, str(e), transitorio=es_error_transitorio(e))
+    finally:
+        if audio:
+            audio.eliminar()
 
 
-def main():
+async def procesar_en_paralelo(videos: Iterable[Path], destination_dir: Path,
+                               huellas: Optional[Dict[Path, str]] = None) -> int:
+    """
+    Procesa los vídeos con MAX_VIDEOS_SIMULTANEOS trabajadores que los toman de una cola acotada,
+    así que 'videos' se va recorriendo a medida que quedan trabajadores libres, sin crear de
+    golpe una tarea por vídeo. 'huellas' puede traer las huellas ya calculadas de algunos vídeos.
+    Devuelve el número de vídeos procesados.
+    """
+    huellas = huellas or {}
+    cola: asyncio.Queue = asyncio.Queue(maxsize=MAX_VIDEOS_SIMULTANEOS)
+    errores_cuota: List[QuotaExhausted] = []
+
+    async def trabajador():
+        while (ruta_video := await cola.get()) is not None:
+            if errores_cuota:
+                continue # Cuota diaria agotada: se descartan los vídeos que quedan en la cola
+            try:
+                await procesar_un_video(ruta_video, destination_dir, huellas.get(ruta_video))
+            except QuotaExhausted as e:
+                errores_cuota.append(e)
+            except Exception as e:
+                # El trabajador tiene que seguir vaciando la cola: si terminara, el bucle que
+                # la llena se quedaría bloqueado esperando sitio
+                logging.error(f"Error inesperado al procesar '{ruta_video.name}': {e}", exc_info=True)
+
+    trabajadores = [asyncio.create_task(trabajador()) for _ in range(MAX_VIDEOS_SIMULTANEOS)]
+    procesados = 0
+    for ruta_video in videos:
+        if errores_cuota:
+            break
+        await cola.put(ruta_video)
+        procesados += 1
+    for _ in trabajadores:
+        await cola.put(None)
+    await asyncio.gather(*trabajadores)
+
+    if errores_cuota:
+        raise errores_cuota[0]
+    return procesados
+
+async def main():
+    global _borrado
     parser = argparse.ArgumentParser(description="Renombra vídeos de críticas de cine usando IA.")
     parser.add_argument("archivo", nargs='?', default=None, type=str, help="Ruta opcional a un archivo de vídeo específico.")
+    parser.add_argument("--no-cache", action="store_true", help="No usar ni actualizar la caché local de respuestas de Gemini, ni reutilizar los nombres ya registrados en el journal.")
+    parser.add_argument("--retry-errors", action="store_true",
+                        help="Volver a procesar también los vídeos de la carpeta 'error' que fallaron por un error transitorio de la API.")
     args = parser.parse_args()
 
+    if args.no_cache:
+        gemini_cache.desactivar()
+
     try:
         base_dir = Path(os.environ["VIDEO_PROCESSING_DIR"])
     except KeyError:
@@ -227,23 +778,23 @@ def main():
 
     try:
         logging.info("Inicializando el modelo de Gemini...")
-        gemini_model = genai.GenerativeModel('gemini-1.5-flash')
+        get_gemini_model()
+    except KeyError:
+        logging.error("La variable de entorno GEMINI_API_KEY no está configurada.")
+        return
     except Exception as e:
         logging.error(f"No se pudo inicializar el modelo de Gemini: {e}", exc_info=True)
         return
     
-    temp_dir = None
-    
+    _borrado = BorradoEnSegundoPlano()
     try:
         if args.archivo:
             ruta_archivo = Path(args.archivo)
             if not ruta_archivo.is_file():
                 logging.error(f"La ruta especificada no es un archivo válido: {args.archivo}")
                 return
-            
-            temp_dir = ruta_archivo.parent / "temp"
-            os.makedirs(temp_dir, exist_ok=True)
-            procesar_un_video(ruta_archivo, gemini_model, temp_dir, base_dir)
+
+            await procesar_un_video(ruta_archivo, base_dir)
 
         else:
             upload_dir = base_dir / "upload"
@@ -251,23 +802,25 @@ def main():
                 logging.error(f"El directorio de subida no existe: {upload_dir}")
                 return
 
-            temp_dir = base_dir / "temp"
-            os.makedirs(temp_dir, exist_ok=True)
-            
-            videos_a_procesar = list(upload_dir.glob("*.mp4")) + list(upload_dir.glob("*.mov"))
-            if not videos_a_procesar:
+            videos_a_procesar = iterar_videos(upload_dir)
+            huellas = {}
+            if args.retry_errors:
+                huellas = await listar_errores_transitorios(base_dir / "error")
+                videos_a_procesar = itertools.chain(videos_a_procesar, huellas)
+
+            logging.info(f"Procesando los vídeos de {upload_dir}...")
+            procesados = await procesar_en_paralelo(videos_a_procesar, base_dir, huellas)
+            if not procesados:
                 logging.info(f"No se encontraron vídeos en {upload_dir}.")
-                return
-            
-            logging.info(f"Encontrados {len(videos_a_procesar)} vídeos para procesar en {upload_dir}.")
-            for ruta_video in videos_a_procesar:
-                procesar_un_video(ruta_video, gemini_model, temp_dir, base_dir)
+            else:
+                logging.info(f"Se procesaron {procesados} vídeos.")
 
+    except QuotaExhausted as e:
+        logging.error(f"Se detiene el procesamiento: {e}")
     finally:
-        # Limpieza final del directorio temporal
-        if temp_dir and temp_dir.exists():
-            logging.info(f"Limpiando directorio temporal: {temp_dir}")
-            shutil.rmtree(temp_dir)
+        # Se espera a que terminen los borrados pendientes antes de salir
+        await _borrado.cerrar()
+        _borrado = None
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
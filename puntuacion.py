@@ -0,0 +1,49 @@
+import re
+from typing import Optional
+
+# --- Configuración ---
+# Puntuaciones dichas de forma inequívoca al final de las críticas ('le doy un 8', 'le pongo un
+# siete y medio', '9,5/10', 'un ocho sobre 10'), que se pueden leer sin consultar a Gemini.
+_NUMEROS_EN_LETRA = {
+    "cero": 0, "uno": 1, "dos": 2, "tres": 3, "cuatro": 4, "cinco": 5,
+    "seis": 6, "siete": 7, "ocho": 8, "nueve": 9, "diez": 10,
+}
+_NUMERO = r'\b(10|[0-9](?:[.,][0-9]+)?|' + "|".join(_NUMEROS_EN_LETRA) + r')\b(\s+y\s+medio\b)?'
+
+# Por orden de prioridad: el verbo deja claro que el número es la nota; '/10' y 'sobre 10' casi
+# siempre también. Formas como 'N puntos' o 'N de 10' son ambiguas ('dos puntos flojos',
+# 'cinco de 10 espectadores') y se dejan para Gemini.
+_PATRONES_PUNTUACION = [
+    re.compile(rf'\ble\s+(?:doy|pongo|damos|ponemos)\s+(?:un\s+|una\s+|la\s+nota\s+de\s+)?{_NUMERO}', re.IGNORECASE),
+    re.compile(rf'{_NUMERO}\s*(?:/\s*10|sobre\s+10)\b', re.IGNORECASE),
+]
+
+# Decimales dichos con palabras ('siete coma cinco', 'siete punto cinco', 'siete con cinco')
+_DECIMAL_HABLADO_DESPUES = re.compile(r'\s+(?:coma|punto|con)\b', re.IGNORECASE)
+_DECIMAL_HABLADO_ANTES = re.compile(r'\b(?:coma|punto|con)\s+$', re.IGNORECASE)
+
+
+def extraer_puntuacion_rapida(transcripcion: str) -> Optional[str]:
+    """
+    Busca en la transcripción una puntuación dicha de forma explícita, sin consultar a Gemini.
+    Devuelve el número como texto ('8', '9.5') o None si no hay ninguna clara.
+    """
+    for patron in _PATRONES_PUNTUACION:
+        coincidencias = list(patron.finditer(transcripcion))
+        if not coincidencias:
+            continue
+        # La puntuación se suele dar al final, así que se toma la última mención
+        coincidencia = coincidencias[-1]
+        numero, medio = coincidencia.groups()
+
+        # Un decimal dicho con palabras no se puede leer bien con la expresión regular
+        if (_DECIMAL_HABLADO_DESPUES.match(transcripcion, coincidencia.end(1))
+                or _DECIMAL_HABLADO_ANTES.search(transcripcion[:coincidencia.start(1)])):
+            return None
+
+        numero = numero.lower()
+        valor = _NUMEROS_EN_LETRA[numero] if numero in _NUMEROS_EN_LETRA else float(numero.replace(',', '.'))
+        if medio:
+            valor += 0.5
+        return f"{valor:g}" if 0 <= valor <= 10 else None
+    return None
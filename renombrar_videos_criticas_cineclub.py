@@ -1,8 +1,9 @@
 import os
+import functools
 import whisper
 import re
 import google.generativeai as genai
-from moviepy.editor import VideoFileClip
+import subprocess
 import tempfile
 import logging
 import argparse
@@ -16,12 +17,22 @@ load_dotenv()
 # Configura un logger para mostrar información de manera más clara
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Configura tu clave de Gemini. Es más seguro leerla de una variable de entorno.
-try:
+@functools.cache
+def get_gemini_model():
+    """
+    Configura la clave de Gemini y crea el modelo la primera vez que se necesitan, y no al
+    importar el módulo. Se puede elegir el modelo con la variable de entorno GEMINI_MODEL.
+    Lanza KeyError si la variable de entorno GEMINI_API_KEY no está configurada.
+    """
+    # Es más seguro leer la clave de una variable de entorno.
     genai.configure(api_key=os.environ["GEMINI_API_KEY"])
-except KeyError:
-    logging.error("La variable de entorno GEMINI_API_KEY no está configurada. Asegúrate de crear un archivo .env con tu clave.")
-    exit()
+    return genai.GenerativeModel(os.getenv("GEMINI_MODEL", "gemini-pro"))
+
+# Extensiones (en minúsculas) de los archivos de vídeo que se procesan.
+EXTENSIONES_VIDEO = {".mp4", ".mov", ".avi", ".mkv"}
+
+# Caracteres no válidos en nombres de archivo (en Windows), que se eliminan del título.
+_INVALID_FN_CHARS = re.compile(r'[\\/*?:"<>|]')
 
 # --- Funciones Auxiliares ---
 
@@ -34,12 +45,22 @@ def obtener_ruta_unica(ruta_propuesta: Path) -> Path:
     if not ruta_propuesta.exists():
         return ruta_propuesta
 
-    contador = 2
-    while True:
-        nueva_ruta = ruta_propuesta.with_stem(f"{ruta_propuesta.stem}_{contador}")
-        if not nueva_ruta.exists():
-            return nueva_ruta
-        contador += 1
+    def con_contador(contador: int) -> Path:
+        return ruta_propuesta.with_stem(f"{ruta_propuesta.stem}_{contador}")
+
+    # Búsqueda exponencial (2, 4, 8...) hasta dar con un sufijo libre y después binaria entre
+    # el último ocupado y ese, para hacer O(log n) comprobaciones en vez de una por duplicado.
+    # Como esta función asigna los sufijos en orden, los ocupados son consecutivos.
+    ocupado, libre = 1, 2
+    while con_contador(libre).exists():
+        ocupado, libre = libre, libre * 2
+    while libre - ocupado > 1:
+        medio = (ocupado + libre) // 2
+        if con_contador(medio).exists():
+            ocupado = medio
+        else:
+            libre = medio
+    return con_contador(libre)
 
 # --- Funciones Principales ---
 
@@ -50,13 +71,15 @@ def transcribir_video(video_path: Path, model) -> str | None:
     """
     try:
         logging.info(f"Extrayendo audio de '{video_path.name}'...")
-        # Crear un archivo temporal para el clip de audio/video
-        with tempfile.NamedTemporaryFile(suffix=".mp4", delete=True) as temp_file:
-            with VideoFileClip(str(video_path)) as clip:
-                # Extraer los primeros 20 segundos o la duración total si es más corto
-                subclip_duration = min(20, clip.duration)
-                clip_sub = clip.subclip(0, subclip_duration)
-                clip_sub.write_videofile(temp_file.name, audio_codec="aac", verbose=False, logger=None)
+        # Crear un archivo temporal para el clip de audio
+        with tempfile.NamedTemporaryFile(suffix=".wav", delete=True) as temp_file:
+            # Extraer solo el audio de los primeros 20 segundos (o menos si el vídeo es más corto),
+            # en mono a 16 kHz, que es el formato con el que trabaja Whisper
+            subprocess.run(
+                ["ffmpeg", "-y", "-t", "20", "-i", str(video_path),
+                 "-vn", "-ac", "1", "-ar", "16000", "-c:a", "pcm_s16le", temp_file.name],
+                check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )
             
             logging.info("Transcribiendo audio con Whisper...")
             result = model.transcribe(temp_file.name, language="es")
@@ -65,7 +88,7 @@ def transcribir_video(video_path: Path, model) -> str | None:
         logging.error(f"No se pudo transcribir el vídeo '{video_path.name}': {e}")
         return None
 
-def obtener_nombre_pelicula(transcripcion: str, gemini_model) -> str | None:
+def obtener_nombre_pelicula(transcripcion: str) -> str | None:
     """
     Usa Gemini para extraer el nombre de la película de un texto.
     """
@@ -80,11 +103,11 @@ def obtener_nombre_pelicula(transcripcion: str, gemini_model) -> str | None:
     )
     try:
         logging.info("Consultando a Gemini para obtener el nombre de la película...")
-        response = gemini_model.generate_content(prompt)
+        response = get_gemini_model().generate_content(prompt)
         # Limpiar el nombre de caracteres no válidos para nombres de archivo usando una expresión regular.
-        # Esto elimina caracteres como / \ : * ? " < > |
+        # Esto elimina caracteres como / \ : * ? " < > | y los puntos o espacios finales.
         nombre_sucio = response.text.strip()
-        nombre_limpio = re.sub(r'[\\/*?:"<>|]', "", nombre_sucio)
+        nombre_limpio = _INVALID_FN_CHARS.sub("", nombre_sucio).rstrip(" .")
         return nombre_limpio if nombre_limpio else "nombre_desconocido"
     except Exception as e:
         logging.error(f"Error al contactar con la API de Gemini: {e}")
@@ -102,18 +125,22 @@ def procesar_videos(carpeta_videos: Path, modelo_whisper: str):
         logging.error(f"No se pudo cargar el modelo Whisper: {e}")
         return
 
-    # *** CORRECCIÓN: Inicializar el modelo de Gemini aquí ***
     logging.info("Inicializando el modelo de Gemini...")
     try:
-        gemini_model = genai.GenerativeModel('gemini-pro')
+        get_gemini_model()
+    except KeyError:
+        logging.error("La variable de entorno GEMINI_API_KEY no está configurada. Asegúrate de crear un archivo .env con tu clave.")
+        return
     except Exception as e:
         logging.error(f"No se pudo inicializar el modelo de Gemini: {e}")
         return
 
-    videos_encontrados = list(carpeta_videos.glob("*.mp4")) + \
-                         list(carpeta_videos.glob("*.mov")) + \
-                         list(carpeta_videos.glob("*.avi")) + \
-                         list(carpeta_videos.glob("*.mkv"))
+    # Una sola pasada por la carpeta; comparar en minúsculas incluye también '.MP4', '.MOV'...
+    with os.scandir(carpeta_videos) as entradas:
+        videos_encontrados = [
+            Path(entrada.path) for entrada in entradas
+            if entrada.is_file() and Path(entrada.name).suffix.lower() in EXTENSIONES_VIDEO
+        ]
 
     if not videos_encontrados:
         logging.warning(f"No se encontraron vídeos en la carpeta '{carpeta_videos}'")
@@ -129,7 +156,7 @@ def procesar_videos(carpeta_videos: Path, modelo_whisper: str):
         if not texto_transcrito:
             continue
 
-        nombre_pelicula = obtener_nombre_pelicula(texto_transcrito, gemini_model)
+        nombre_pelicula = obtener_nombre_pelicula(texto_transcrito)
         if not nombre_pelicula or nombre_pelicula == "nombre_desconocido":
             logging.warning(f"No se pudo obtener el nombre de la película para '{ruta_video_actual.name}'. Saltando archivo.")
             continue
@@ -0,0 +1,63 @@
+import unittest
+from types import SimpleNamespace
+
+from cuota_gemini import es_cuota_diaria, leer_retry_delay
+
+# Cuerpos de error de cuota tal y como llegan en el texto de la excepción
+_JSON_POR_MINUTO = (
+    '429 Quota exceeded. {"error": {"code": 429, "details": ['
+    '{"@type": "type.googleapis.com/google.rpc.QuotaFailure", '
+    '"violations": [{"quotaId": "GenerateRequestsPerMinutePerProjectPerModel-FreeTier"}]}, '
+    '{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": "59s"}]}}'
+)
+_PROTOBUF_POR_DIA = (
+    '429 You exceeded your current quota. [violations {\n'
+    '  quota_id: "GenerateRequestsPerDayPerProjectPerModel-FreeTier"\n'
+    '}\n'
+    ', retry_delay {\n'
+    '  seconds: 37\n'
+    '}\n'
+    ']'
+)
+
+
+class TestLeerRetryDelay(unittest.TestCase):
+
+    def test_formato_json(self):
+        self.assertEqual(leer_retry_delay(Exception(_JSON_POR_MINUTO)), 59)
+
+    def test_formato_protobuf(self):
+        self.assertEqual(leer_retry_delay(Exception(_PROTOBUF_POR_DIA)), 37)
+
+    def test_detalles_estructurados(self):
+        error = Exception("429")
+        error.details = [SimpleNamespace(retry_delay=SimpleNamespace(seconds=12, nanos=500_000_000))]
+        self.assertEqual(leer_retry_delay(error), 12.5)
+
+    def test_sin_retry_delay(self):
+        self.assertIsNone(leer_retry_delay(Exception("429 Resource has been exhausted")))
+
+
+class TestEsCuotaDiaria(unittest.TestCase):
+
+    def test_cuota_por_dia(self):
+        self.assertTrue(es_cuota_diaria(Exception(_PROTOBUF_POR_DIA)))
+        self.assertTrue(es_cuota_diaria(Exception('"quotaId": "GenerateRequestsPerDayPerProject"')))
+
+    def test_cuota_por_minuto(self):
+        self.assertFalse(es_cuota_diaria(Exception(_JSON_POR_MINUTO)))
+        self.assertFalse(es_cuota_diaria(Exception('quota_id: "GenerateRequestsPerMinutePerProject"')))
+
+    def test_detalles_estructurados(self):
+        error = Exception("429")
+        error.details = [SimpleNamespace(violations=[SimpleNamespace(quota_id="GenerateRequestsPerDayPerProject")])]
+        self.assertTrue(es_cuota_diaria(error))
+        error.details = [SimpleNamespace(violations=[SimpleNamespace(quota_id="GenerateRequestsPerMinutePerProject")])]
+        self.assertFalse(es_cuota_diaria(error))
+
+    def test_sin_quota_id(self):
+        self.assertFalse(es_cuota_diaria(Exception("429 Resource has been exhausted")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+
+from puntuacion import extraer_puntuacion_rapida
+
+
+class TestExtraerPuntuacionRapida(unittest.TestCase):
+
+    def test_puntuaciones_explicitas(self):
+        casos = {
+            "Y por todo esto le doy un 8.": "8",
+            "le doy un 8 y medio": "8.5",
+            "Le pongo un siete y medio.": "7.5",
+            "Mi nota: 9,5/10": "9.5",
+            "un ocho sobre 10, sin duda": "8",
+            "Vi 3 veces la película, le doy un diez": "10",
+            "le doy un 6,5": "6.5",
+        }
+        for transcripcion, esperado in casos.items():
+            with self.subTest(transcripcion=transcripcion):
+                self.assertEqual(extraer_puntuacion_rapida(transcripcion), esperado)
+
+    def test_el_verbo_tiene_prioridad_sobre_otros_numeros(self):
+        self.assertEqual(extraer_puntuacion_rapida("tiene dos puntos flojos pero le doy un nueve"), "9")
+        self.assertEqual(extraer_puntuacion_rapida("cinco de 10 espectadores se dormirán, le doy un 3"), "3")
+
+    def test_casos_ambiguos_se_dejan_para_gemini(self):
+        casos = [
+            "le doy un siete coma cinco",
+            "le pongo un siete punto cinco",
+            "le doy un siete con cinco",
+            "tiene dos puntos flojos",
+            "cinco de 10 espectadores se dormirán",
+            "Tiene 2 horas de duración. Muy recomendable.",
+            "le doy un 12",
+        ]
+        for transcripcion in casos:
+            with self.subTest(transcripcion=transcripcion):
+                self.assertIsNone(extraer_puntuacion_rapida(transcripcion))
+
+
+if __name__ == "__main__":
+    unittest.main()